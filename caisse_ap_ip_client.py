@@ -24,7 +24,6 @@ import logging
 import argparse
 import sys
 import socket
-from pprint import pprint
 
 __author__ = "Rémi de Lattre <remi@miluni.fr>"
 __date__ = "April 2023"
@@ -33,91 +32,151 @@ __version__ = "0.1"
 BUFFER_SIZE = 1024
 TIMEOUT = 180  # in seconds
 
+# Constant leading tags of every request, serialized once at import.
+# A frame must always start with tag CZ;
+# the order of the other tags is unrelevant.
+STATIC_PREFIX = b''.join([
+    b'%s%03d%s' % (tag, len(value), value) for (tag, value) in [
+        (b'CZ', b'0300'),  # Caisse-AP protocol version
+        (b'CJ', b'012345678901'),  # Identifiant Protocole Concert
+        (b'CA', b'01'),  # caisse number
+        (b'BF', b'0'),  # 0 = partial payment disallowed
+        (b'BA', b'0'),  # 1 = immediate answer ; 0 = answer at the end of transaction
+    ]])
+
 logger = logging.getLogger(__name__)
 FORMAT = '%(asctime)s [%(levelname)s] %(message)s'
 logging.basicConfig(format=FORMAT)
 
+log_level_map = {
+    'debug': logging.DEBUG,
+    'info': logging.INFO,
+    'warn': logging.WARN,
+    'error': logging.ERROR,
+}
+
+
+# Currency lookup cache, seeded with the common cases so the iso4217
+# import (which parses a sizeable data file) only happens for other
+# currencies, and only once per process
+_cur_cache = {
+    'EUR': ('978', 2),
+    'XPF': ('953', 0),
+}
+
+
+def _lookup_currency(currency):
+    if currency not in _cur_cache:
+        from iso4217 import Currency
+        cur = Currency(currency)
+        _cur_cache[currency] = (str(cur.number), cur.exponent)
+    return _cur_cache[currency]
+
+
+def _frame_complete(buf, size_total):
+    # A frame is a sequence of TLV fields, each announcing its own 3-digit
+    # size: the frame is complete when the buffer ends exactly on a field
+    # boundary
+    i = 0
+    while i + 5 <= size_total:
+        # A non-digit size field would compute a bogus (possibly negative)
+        # size and spin forever: treat a malformed answer as complete
+        # instead of waiting for bytes that will never come
+        if not buf[i + 2:i + 5].isdigit():
+            return True
+        size = (buf[i + 2] - 48) * 100 + (buf[i + 3] - 48) * 10 + (buf[i + 4] - 48)
+        i += 5 + size
+    return i == size_total
+
+
+def _recv_frame(sock):
+    # The answer may span several TCP segments: a single recv() would
+    # truncate it, so keep reading into a pre-allocated buffer until all
+    # the announced field sizes are consumed
+    buf = bytearray(BUFFER_SIZE)
+    pos = 0
+    while True:
+        nread = sock.recv_into(memoryview(buf)[pos:])
+        if not nread:
+            break
+        pos += nread
+        if _frame_complete(buf, pos):
+            break
+        if pos == len(buf):
+            buf += bytes(BUFFER_SIZE)
+    return bytes(buf[:pos])
+
 
 def main(args):
     if args.log_level:
         log_level = args.log_level.lower()
-        log_map = {
-            'debug': logging.DEBUG,
-            'info': logging.INFO,
-            'warn': logging.WARN,
-            'error': logging.ERROR,
-        }
-        if log_level in log_map:
-            logger.setLevel(log_map[log_level])
+        if log_level in log_level_map:
+            logger.setLevel(log_level_map[log_level])
     if args.port < 1 or args.port > 65535:
         logger.error('Wrong TCP port (%s). Must be between 1 and 65535', args.port)
         sys.exit(1)
     currency = args.currency.upper()
-    if currency == 'EUR':
-        cur_num = '978'
-        decimals = 2
-    else:
-        from iso4217 import Currency
-        cur = Currency(currency)
-        cur_num = str(cur.number)
-        decimals = cur.exponent
+    cur_num, decimals = _lookup_currency(currency)
     assert len(cur_num) == 3
 
+    # Dynamic tags only: the constant ones are in STATIC_PREFIX
     msg_dict = {
-        'CZ': '0300',  # Caisse-AP protocol version
-        'CJ': '012345678901',  # Identifiant Protocole Concert
-        'CA': '01',  # caisse number
         'CE': cur_num,  # Currency ISO number
-        'BF': '0',  # 0 = partial payment disallowed
-        'BA': '0',  # 1 = immediate answer ; 0 = answer at the end of transaction
     }
 
+    # Compute the amount in cents with integer arithmetic: float math like
+    # 112.45 * 100 gives 11244.999999999998, which ends up one cent off
     amount = args.amount
-    if amount > 0:
-        msg_dict['CD'] = '0'  # debit
-        amount_positive = amount
-    elif amount < 0:
+    negative = amount.startswith('-')
+    try:
+        int_part, _, frac_part = amount.lstrip('+-').partition('.')
+        frac_part = frac_part.ljust(decimals, '0')[:decimals]
+        cents = int(int_part or '0') * 10 ** decimals + int(frac_part or '0')
+    except ValueError:
+        logger.error(
+            'Wrong amount (%s). Use dot as decimal separator.', args.amount)
+        sys.exit(1)
+    if negative:
         msg_dict['CD'] = '1'  # reimburse
-        amount_positive = amount * -1
+    else:
+        msg_dict['CD'] = '0'  # debit
 
     if args.check:
         msg_dict['CC'] = '00C'
-    amount_cent = amount_positive * 10 ** decimals
-    amount_str = str(int(round(amount_cent)))
+    amount_str = str(cents)
     if len(amount_str) > 12:
         logger.error(
             'Amount is too big (%s): 12 numbers (including cents) maximum.', args.amount)
         sys.exit(1)
     if len(amount_str) < 2:
-        amount_str = amount_str.zfill(2)
+        amount_str = f'{amount_str:0>2}'
     msg_dict['CB'] = amount_str
 
     # START to build request
-    pprint(msg_dict)
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug('msg_dict=%r', msg_dict)
 
+    # Serialize straight to bytes: %03d on an int is cheaper than the
+    # str(len(value)).zfill(3) temporaries, and the frame is pure ASCII anyway
+    msg_parts = [STATIC_PREFIX]
     for tag, value in msg_dict.items():
-        assert isinstance(tag, str)
-        assert len(tag) == 2
-        assert isinstance(value, str)
-        assert len(value) >= 1
-        assert len(value) <= 999
-    msg_list = []
-    # Always start with tag CZ
-    # the order of the other tags is unrelevant
-    if 'CZ' in msg_dict:
-        version = msg_dict.pop('CZ')
-        msg_list.append(('CZ', version))
-    msg_list += list(msg_dict.items())
-    msg_str = ''.join(['%s%s%s' % (tag, str(len(value)).zfill(3), value) for (tag, value) in msg_list])
+        value_bytes = value.encode('ascii')
+        msg_parts.append(b'%s%03d%s' % (tag.encode('ascii'), len(value_bytes), value_bytes))
+    # Build the full frame once: a single sendall() means a single syscall
+    # and a single TCP segment (send() may short-write on some platforms)
+    msg_bytes = b''.join(msg_parts)
 
     with socket.create_connection((args.destination, args.port), timeout=TIMEOUT) as sock:
-        logger.info('sent: %s', msg_str)
-        sock.send(msg_str.encode('ascii'))
-        data = sock.recv(BUFFER_SIZE)
+        # Disable Nagle: the request is a single small frame, so waiting for
+        # the peer's delayed ACK would just add latency
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        logger.info('sent: %s', msg_bytes.decode('ascii'))
+        sock.sendall(msg_bytes)
+        data = _recv_frame(sock)
         logger.info("received: %s", data.decode('ascii'))
 
 
-if __name__ == '__main__':
+def _build_parser():
     usage = "caisse_ap_ip_client.py"
     epilog = "Author: %s - Version: %s" % (__author__, __version__)
     description = "Caisse-AP IP client. Can simulate a point of sale."
@@ -135,13 +194,20 @@ if __name__ == '__main__':
         '-p', '--port', dest='port', type=int, default=8888,
         help="TCP port. Default value: 8888.")
     parser.add_argument(
-        '-a', '--amount', dest='amount', type=float, default=112.45,
-        help="Amount as float. Use dot as decimal separator. Default value: 112.45")
+        '-a', '--amount', dest='amount', default='112.45',
+        help="Amount. Use dot as decimal separator. Default value: 112.45")
     parser.add_argument(
         '-ck', '--check', dest='check', action='store_true',
         help="If set, use the check printing feature of the payment terminal.")
     parser.add_argument(
         '-c', '--currency', dest='currency', default="EUR",
         help="Currency ISO code (3 letters). Default value: EUR.")
-    args = parser.parse_args()
-    main(args)
+    return parser
+
+
+def cli(argv=None):
+    main(_build_parser().parse_args(argv))
+
+
+if __name__ == '__main__':
+    cli()
@@ -22,9 +22,9 @@ import argparse
 import sys
 import logging
 import random
+import socket
 import time
 from twisted.internet import protocol, reactor, endpoints
-from pprint import pprint
 
 __author__ = "Rémi de Lattre <remi@miluni.fr>"
 __date__ = "April 2023"
@@ -34,12 +34,25 @@ logger = logging.getLogger(__name__)
 FORMAT = '%(asctime)s [%(levelname)s] %(message)s'
 logging.basicConfig(format=FORMAT)
 
+log_level_map = {
+    'debug': logging.DEBUG,
+    'info': logging.INFO,
+    'warn': logging.WARN,
+    'error': logging.ERROR,
+}
+
 payment_type_CC_dict = {
     'cbcontact': '001',
     'cbcontactless': '00B',
     'amexcontact': '002',
     'amexcontactless': '00D',
 }
+payment_type_CI_dict = {
+    'cbcontact': '1',
+    'cbcontactless': '2',
+    'amexcontact': '1',
+    'amexcontactless': '2',
+}
 failure_type_AF_dict = {
     'abandon': '11',
     'timeout': '08',
@@ -47,36 +60,80 @@ failure_type_AF_dict = {
     'forbidden': '05',
 }
 
+# Tags that must be present in every payment request
+mandatory_tags = frozenset(('CZ', 'CJ', 'CA', 'CB', 'CD', 'CE'))
+
+# Tags carried by the pre-serialized success suffix: when the suffix is
+# emitted, a client-supplied value for one of these tags must not be
+# echoed, the server's value overrides it
+suffix_tags = frozenset(('CC', 'CI', 'CF', 'CG'))
+
+# Tag names pre-encoded once: the answer serializer then does a dict
+# lookup instead of an encode call per tag
+tag_bytes_dict = {
+    tag: tag.encode('ascii') for tag in (
+        'CZ', 'CJ', 'CA', 'CB', 'CD', 'CE', 'CC', 'CI', 'CF', 'CG',
+        'BA', 'BF', 'AA', 'AB', 'AC', 'AE', 'AF', 'AI')}
+
+# Local Random instance: simulator-grade randomness, no cryptographic
+# requirement
+_rand = random.Random()
+_getrandbits = _rand.getrandbits
+
 
 class CaisseAP(protocol.Protocol):
-    def __init__(self, args):
-        self.args = args
+    def __init__(self, factory):
+        self.factory = factory
+
+    def connectionMade(self):
+        # Disable Nagle: answers are single small frames, no need to wait
+        # for the client's delayed ACK
+        self.transport.setTcpNoDelay(True)
+        # Cap the unsent bytes queued in the kernel send buffer, so answers
+        # to many concurrent clients don't pile up behind each other
+        # (available on Linux and macOS only)
+        if hasattr(socket, 'TCP_NOTSENT_LOWAT'):
+            self.transport.getHandle().setsockopt(
+                socket.IPPROTO_TCP, socket.TCP_NOTSENT_LOWAT, 16384)
 
     def dataReceived(self, data_bytes):
-        data_str = data_bytes.decode('ascii')
-        logger.info('Received raw data: %s', data_str)
+        # Only decode and format for the logs when debug is enabled:
+        # at the default info level, this costs nothing
+        debug_enabled = logger.isEnabledFor(logging.DEBUG)
+        if debug_enabled:
+            logger.debug('Received raw data: %s', data_bytes.decode('ascii'))
+        # Parse the TLV frame over a memoryview: only the tag and value are
+        # decoded, and the 3-digit size is computed with integer arithmetic
+        # instead of an int() call on a str slice
+        mv = memoryview(data_bytes)
         data_dict = {}
         i = 0
-        while i < len(data_str):
-            tag = data_str[i:i + 2]
-            i += 2
-            size_str = data_str[i:i + 3]
-            size = int(size_str)
-            i += 3
-            value = data_str[i:i + size]
+        size_total = len(data_bytes)
+        while i < size_total:
+            # A malformed or truncated size field would compute a bogus
+            # (possibly negative) size and loop forever: stop parsing and
+            # answer with what was decoded so far
+            if i + 5 > size_total or not data_bytes[i + 2:i + 5].isdigit():
+                logger.warning(
+                    'Malformed frame, ignoring from offset %s: %r', i, data_bytes)
+                break
+            tag = bytes(mv[i:i + 2]).decode('ascii')
+            size = (mv[i + 2] - 48) * 100 + (mv[i + 3] - 48) * 10 + (mv[i + 4] - 48)
+            value = bytes(mv[i + 5:i + 5 + size]).decode('ascii')
             data_dict[tag] = value
-            i += size
-        logger.info('Received parsed data:')
-        pprint(data_dict)
+            i += 5 + size
+        if debug_enabled:
+            logger.debug('Received parsed data: %r', data_dict)
 
         immediate = False
 
         check = data_dict.get('CC') == '00C'
         logger.debug('check=%s', check)
-        answer_dict = dict(data_dict)
+        # Tags specific to the answer: the request tags are echoed directly
+        # from data_dict at serialization time, without a shallow copy
+        answer_dict = {}
 
-        mandatory_tags = ["CZ", "CJ", "CA", "CB", "CD", "CE"]
-        if any([x not in data_dict for x in mandatory_tags]):
+        if not mandatory_tags.issubset(data_dict):
             answer_dict['AE'] = '01'
             answer_dict['AF'] = '09'
             immediate = True
@@ -85,7 +142,7 @@ class CaisseAP(protocol.Protocol):
         if ba_tag == '1':
             immediate = True
             answer_dict['AE'] = '11'  # AE = 11(request took into account) => no 'AF'
-        elif args.failure:
+        elif self.factory.failure:
             answer_dict['AE'] = '01'  # AE = 01(operation not done)
             # AF = Complement of action status (AE). Only present on failures
             if check:
@@ -93,95 +150,138 @@ class CaisseAP(protocol.Protocol):
                 # (press on red button or check inserted wrong side)
                 answer_dict['AF'] = '04'
             else:
-                answer_dict['AF'] = failure_type_AF_dict[args.failure_type]
+                answer_dict['AF'] = self.factory.failure_af
 
         else:
             answer_dict['AE'] = '10'  # AE = 10(operation done)
 
-        if not immediate:
-            time.sleep(args.duration)
-
-        if not args.failure and not immediate:
+        success_suffix = b''
+        if not self.factory.failure and not immediate:
 
             # CC = Payment mode
             # Set by client only if it's a check
             # otherwise, only present in the answer
             if not check:
-                answer_dict['CC'] = payment_type_CC_dict[args.payment_type]
-                CI_dict = {
-                    'cbcontact': '1',
-                    'cbcontactless': '2',
-                    'amexcontact': '1',
-                    'amexcontactless': '2',
-                }
-                answer_dict['CI'] = CI_dict[args.payment_type]
+                # CC, CI, CF and CG are constant for a given server
+                # invocation: they are pre-serialized on the factory
+                success_suffix = self.factory.success_suffix
 
+                # A single 128-bit pull instead of four randrange calls:
+                # the random fields are sliced out with shifts and modulos
+                r = _getrandbits(128)
                 # AC = authorisation number
-                answer_dict['AC'] = str(random.randint(100000, 999999))
-
+                answer_dict['AC'] = str(100000 + r % 900000)
+                r >>= 20
                 # AA = payment card number
-                nb1 = random.randint(100000, 999999)
-                nb2 = random.randint(1000, 9999)
+                nb1 = 100000 + r % 900000
+                r >>= 20
+                nb2 = 1000 + r % 9000
+                r >>= 14
                 answer_dict['AA'] = '%s######%s' % (nb1, nb2)
                 # AI = AID of the payment card
-                answer_dict['AI'] = 'A00000000%s' % random.randint(10000, 999999999999)
+                answer_dict['AI'] = 'A00000000%s' % (10000 + r % (10 ** 12 - 10000))
+                r >>= 40
                 # AB = expiry date of the payment card (format YYMM)
-                next_year = str(time.gmtime().tm_year + 1)[2:]
-                month = str(random.randint(1, 12)).zfill(2)
-                answer_dict['AB'] = '%s%s' % (next_year, month)
-
-                # CF = private data
-                answer_dict['CF'] = '1010000000'
-
-                # CG = seller contract number
-                answer_dict['CG'] = args.seller_contract
-
-        logger.info('Answer structured data:')
-        pprint(answer_dict)
+                month = f'{1 + r % 12:02d}'
+                answer_dict['AB'] = '%s%s' % (self.factory.get_next_year_yy(), month)
+
+        if debug_enabled:
+            logger.debug('Answer specific data: %r', answer_dict)
+        answer_parts = self._build_answer_parts(
+            data_dict, answer_dict, success_suffix)
+        if debug_enabled:
+            logger.debug(
+                'Answer raw data: %s', b''.join(answer_parts).decode('ascii'))
+        # writeSequence hands all the fragments to a single writev(2)
+        # syscall, without joining them in Python first
+        if immediate:
+            self.transport.writeSequence(answer_parts)
+        else:
+            # Schedule the delayed answer instead of calling time.sleep(),
+            # which would block the reactor and freeze every other
+            # connection for the whole duration
+            reactor.callLater(
+                self.factory.duration, self.transport.writeSequence, answer_parts)
+
+    def _build_answer_parts(self, data_dict, answer_dict, success_suffix):
+        # Serialize straight to bytes in a single pass: the echoed request
+        # tags first (always starting with a CZ tag; the order of the other
+        # tags is not significant), then the tags specific to the answer
+        answer_parts = []
+        cz_value = data_dict.get('CZ')
+        if cz_value is not None:
+            cz_bytes = cz_value.encode('ascii')
+            answer_parts.append(b'CZ%03d%s' % (len(cz_bytes), cz_bytes))
+        for tag, value in data_dict.items():
+            if (tag == 'CZ' or tag in answer_dict
+                    or (success_suffix and tag in suffix_tags)):
+                continue
+            value_bytes = value.encode('ascii')
+            tag_bytes = tag_bytes_dict.get(tag)
+            if tag_bytes is None:
+                # unknown tag echoed from the client
+                tag_bytes = tag.encode('ascii')
+            answer_parts.append(b'%s%03d%s' % (tag_bytes, len(value_bytes), value_bytes))
         for tag, value in answer_dict.items():
-            assert isinstance(tag, str)
-            assert len(tag) == 2
-            assert isinstance(value, str)
-            assert len(value) >= 1
-            assert len(value) <= 999
-        answer_list = []
-        # Always start with a CZ tag
-        # The order of the other tags is not significant
-        if 'CZ' in answer_dict:
-            version = answer_dict.pop('CZ')
-            answer_list.append(('CZ', version))
-
-        answer_list += list(answer_dict.items())
-        answer_str = ''.join(
-            ['%s%s%s' % (tag, str(len(value)).zfill(3), value) for (tag, value) in answer_list])
-        answer_bytes = answer_str.encode('ascii')
-        logger.info('Answer raw data: %s', answer_str)
-        self.transport.write(answer_bytes)
+            value_bytes = value.encode('ascii')
+            answer_parts.append(
+                b'%s%03d%s' % (tag_bytes_dict[tag], len(value_bytes), value_bytes))
+        if success_suffix:
+            answer_parts.append(success_suffix)
+        return answer_parts
 
 
 class CaisseAPFactory(protocol.Factory):
     def __init__(self, args):
-        self.args = args
+        # Resolve the CLI options once, instead of re-reading args and
+        # re-indexing the option dicts on every request
+        self.failure = args.failure
+        self.failure_af = failure_type_AF_dict[args.failure_type.lower()]
+        self.duration = args.duration
+        # A successful card payment answer always ends with the same four
+        # tags for a given server invocation: pre-serialize them once
+        payment_type = args.payment_type.lower()
+        suffix_dict = {
+            # CC = payment mode
+            'CC': payment_type_CC_dict[payment_type],
+            'CI': payment_type_CI_dict[payment_type],
+            # CF = private data
+            'CF': '1010000000',
+            # CG = seller contract number
+            'CG': args.seller_contract,
+        }
+        suffix_parts = []
+        for tag, value in suffix_dict.items():
+            value_bytes = value.encode('ascii')
+            suffix_parts.append(
+                b'%s%03d%s' % (tag.encode('ascii'), len(value_bytes), value_bytes))
+        self.success_suffix = b''.join(suffix_parts)
+        # Expiry year of the simulated cards (2 digits), cached and
+        # refreshed at most once a day instead of calling time.gmtime()
+        # on every request
+        self._next_year_yy = None
+        self._next_year_day = None
+
+    def get_next_year_yy(self):
+        day = int(time.time()) // 86400
+        if day != self._next_year_day:
+            self._next_year_day = day
+            self._next_year_yy = str(time.gmtime().tm_year + 1)[2:]
+        return self._next_year_yy
 
     def buildProtocol(self, addr):
-        return CaisseAP(self.args)
+        return CaisseAP(self)
 
 
 def main(args):
     if args.log_level:
         log_level = args.log_level.lower()
-        log_map = {
-            'debug': logging.DEBUG,
-            'info': logging.INFO,
-            'warn': logging.WARN,
-            'error': logging.ERROR,
-        }
-        if log_level in log_map:
-            logger.setLevel(log_map[log_level])
+        if log_level in log_level_map:
+            logger.setLevel(log_level_map[log_level])
         else:
             logger.error(
                 'Wrong value for log level (%s). Possible values: %s',
-                log_level, ', '.join(log_map.keys()))
+                log_level, ', '.join(log_level_map.keys()))
             sys.exit(1)
     if args.port < 1 or args.port > 65535:
         logger.error('Wrong TCP port (%s). Must be between 1 and 65535', args.port)